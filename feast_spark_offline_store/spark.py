@@ -1,13 +1,17 @@
-from typing import List, Union, Optional, Dict
+import re
+from contextlib import contextmanager
+from functools import cached_property
+from typing import List, Union, Optional, Dict, Iterator, Tuple, Any
 from pydantic import StrictStr
-from datetime import datetime
+from datetime import datetime, timezone
+from dataclasses import asdict
+from jinja2 import BaseLoader, Environment
 
 import pandas
 import pyspark
 import pyarrow
 import numpy as np
 import pandas as pd
-from pytz import utc
 
 from feast.registry import Registry
 from feast import FeatureView, OnDemandFeatureView
@@ -18,10 +22,30 @@ from feast.infra.offline_stores import offline_utils
 from feast.errors import InvalidEntityType
 
 from pyspark.sql import SparkSession
-from pyspark import SparkConf
+from pyspark.sql.functions import expr
+from pyspark.sql.types import TimestampType
+from pyspark.sql.pandas.types import to_arrow_schema
+from pyspark import InheritableThread, SparkConf
+from pyspark.rdd import _local_iterator_from_socket
+from pyspark.serializers import NoOpSerializer
 from feast_spark_offline_store.spark_source import SparkSource
 from feast_spark_offline_store.spark_type_map import spark_schema_to_np_dtypes
 
+_UTC = timezone.utc
+
+# SparkSession.sql binds Python values to named parameter markers since 3.5
+_SQL_ARGS_SUPPORTED = tuple(map(int, pyspark.__version__.split(".")[:2])) >= (3, 5)
+
+# defaults for sessions started by the offline store, letting AQE split skewed
+# entity joins and broadcast small entity dataframes without cluster tuning
+_DEFAULT_SPARK_CONF = {
+    "spark.sql.adaptive.enabled": "true",
+    "spark.sql.adaptive.skewJoin.enabled": "true",
+    "spark.sql.adaptive.coalescePartitions.enabled": "true",
+    "spark.sql.adaptive.advisoryPartitionSizeInBytes": "64m",
+    "spark.sql.autoBroadcastJoinThreshold": "50m",
+}
+
 
 class SparkOfflineStoreConfig(FeastConfigBaseModel):
     type: StrictStr = "spark"
@@ -32,6 +56,28 @@ class SparkOfflineStoreConfig(FeastConfigBaseModel):
     # to ensure sparksession is the correct config, if not created yet
     # sparksession is not serializable and we dont want to pass it around as an argument
 
+    arrow_enabled: bool = True
+    """ Use Arrow to transfer data between Spark and pandas, disable for schemas
+    Arrow does not support (e.g. ArrayType(TimestampType)) """
+
+    batch_size: Optional[int] = None
+    """ Maximum number of records per Arrow record batch """
+
+    cache_intermediate: bool = False
+    """ Cache the entity_dataframe view that every feature view join reads from,
+    repartitioned by join keys when all feature views share the same ones """
+
+    entity_cardinalities: Optional[Dict[str, int]] = None
+    """ Approximate distinct counts of join keys, used to order window partitions """
+
+    parallel_feature_views: bool = False
+    """ Materialize the point-in-time join of each feature view concurrently """
+
+    scheduler_pool: Optional[str] = None
+    """ Spark scheduler pool for the concurrent feature view jobs, e.g. a FAIR pool
+    defined in spark.scheduler.allocation.file. Requires pinned thread mode
+    (PYSPARK_PIN_THREAD=true, the default since Spark 3.2) """
+
 
 class SparkOfflineStore(OfflineStore):
     @staticmethod
@@ -56,7 +102,11 @@ class SparkOfflineStore(OfflineStore):
 
         from_expression = data_source.get_table_query_string()
 
-        partition_by_join_key_string = ", ".join(join_key_columns)
+        partition_by_join_key_string = ", ".join(
+            _sort_by_cardinality(
+                join_key_columns, config.offline_store.entity_cardinalities
+            )
+        )
         if partition_by_join_key_string != "":
             partition_by_join_key_string = (
                 "PARTITION BY " + partition_by_join_key_string
@@ -70,13 +120,25 @@ class SparkOfflineStore(OfflineStore):
         start_date = _format_datetime(start_date)
         end_date = _format_datetime(end_date)
 
+        if _SQL_ARGS_SUPPORTED:
+            # bound parameters keep the query text identical across date ranges
+            timestamp_range_string = (
+                "CAST(:start_date AS TIMESTAMP) AND CAST(:end_date AS TIMESTAMP)"
+            )
+            query_args = {"start_date": start_date, "end_date": end_date}
+        else:
+            timestamp_range_string = (
+                f"TIMESTAMP('{start_date}') AND TIMESTAMP('{end_date}')"
+            )
+            query_args = None
+
         query = f"""
                 SELECT {field_string}
                 FROM (
                     SELECT {field_string},
                     ROW_NUMBER() OVER({partition_by_join_key_string} ORDER BY {timestamp_desc_string}) AS feast_row_
                     FROM {from_expression} t1
-                    WHERE {event_timestamp_column} BETWEEN TIMESTAMP('{start_date}') AND TIMESTAMP('{end_date}')
+                    WHERE {event_timestamp_column} BETWEEN {timestamp_range_string}
                 ) t2
                 WHERE feast_row_ = 1
                 """
@@ -86,6 +148,8 @@ class SparkOfflineStore(OfflineStore):
             query=query,
             full_feature_names=False,
             on_demand_feature_views=None,
+            query_args=query_args,
+            arrow_conf=_get_arrow_conf(config.offline_store),
         )
 
     @staticmethod
@@ -105,10 +169,12 @@ class SparkOfflineStore(OfflineStore):
         )
 
         table_name = offline_utils.get_temp_entity_table_name()
+        arrow_conf = _get_arrow_conf(config.offline_store)
 
-        entity_schema = _upload_entity_df_and_get_entity_schema(
-            spark_session, table_name, entity_df
-        )
+        with _session_conf(spark_session, arrow_conf):
+            entity_schema = _upload_entity_df_and_get_entity_schema(
+                spark_session, table_name, entity_df
+            )
 
         entity_df_event_timestamp_col = (
             offline_utils.infer_event_timestamp_from_entity_df(entity_schema)
@@ -129,12 +195,34 @@ class SparkOfflineStore(OfflineStore):
             project,
         )
 
-        query = offline_utils.build_point_in_time_query(
+        min_entity_timestamp, max_entity_timestamp = _get_entity_df_timestamp_bounds(
+            spark_session, table_name, entity_df_event_timestamp_col
+        )
+
+        # repartitioned after computing the bounds, which would otherwise pay for the shuffle
+        left_table_query_string = table_name
+        feature_view_join_keys = {
+            frozenset(context.entities) for context in query_context
+        }
+        if config.offline_store.cache_intermediate and len(feature_view_join_keys) == 1:
+            join_keys = sorted(next(iter(feature_view_join_keys)))
+            if join_keys:
+                # co-locate entity rows by the join key all feature views share, the
+                # cached entity_dataframe view built on top of it keeps the partitioning
+                left_table_query_string = f"{table_name}_repartitioned"
+                spark_session.table(table_name).repartition(
+                    *join_keys
+                ).createOrReplaceTempView(left_table_query_string)
+
+        query = _build_point_in_time_query(
             query_context,
-            left_table_query_string=table_name,
+            left_table_query_string=left_table_query_string,
             entity_df_event_timestamp_col=entity_df_event_timestamp_col,
-            entity_df_columns=entity_schema.keys(),
-            query_template=MULTIPLE_FEATURE_VIEW_POINT_IN_TIME_JOIN,
+            min_entity_timestamp=min_entity_timestamp,
+            max_entity_timestamp=max_entity_timestamp,
+            broadcast_entity_df=_entity_df_fits_broadcast_threshold(
+                spark_session, entity_df
+            ),
             full_feature_names=full_feature_names,
         )
 
@@ -145,6 +233,14 @@ class SparkOfflineStore(OfflineStore):
             on_demand_feature_views=OnDemandFeatureView.get_requested_odfvs(
                 feature_refs, project, registry
             ),
+            cache_intermediate=config.offline_store.cache_intermediate,
+            parallel_views=(
+                [f"{context.name}__cleaned" for context in query_context]
+                if config.offline_store.parallel_feature_views
+                else None
+            ),
+            scheduler_pool=config.offline_store.scheduler_pool,
+            arrow_conf=arrow_conf,
         )
 
 
@@ -156,12 +252,25 @@ class SparkRetrievalJob(RetrievalJob):
         query: str,
         full_feature_names: bool,
         on_demand_feature_views: Optional[List[OnDemandFeatureView]],
+        cache_intermediate: bool = False,
+        query_args: Optional[Dict[str, Any]] = None,
+        parallel_views: Optional[List[str]] = None,
+        scheduler_pool: Optional[str] = None,
+        arrow_conf: Optional[Dict[str, str]] = None,
     ):
         super().__init__()
         self.spark_session = spark_session
         self.query = query
         self._full_feature_names = full_feature_names
         self._on_demand_feature_views = on_demand_feature_views
+        self._cache_intermediate = cache_intermediate
+        self._query_args = query_args
+        self._parallel_views = parallel_views
+        self._scheduler_pool = scheduler_pool
+        self._arrow_conf = arrow_conf or {}
+        # TODO can do better than this dirty split
+        self._statements = [s for s in query.split("---EOS---") if s.strip()]
+        self._final_df: Optional[pyspark.sql.DataFrame] = None
 
     @property
     def full_feature_names(self) -> bool:
@@ -171,15 +280,86 @@ class SparkRetrievalJob(RetrievalJob):
     def on_demand_feature_views(self) -> Optional[List[OnDemandFeatureView]]:
         return self._on_demand_feature_views
 
+    @cached_property
+    def schema(self) -> pyarrow.Schema:
+        """Return the schema of to_arrow() without executing the query
+
+        Raises TypeError for Spark types Arrow does not support.
+        """
+        return _get_arrow_schema(self.spark_session, self.to_spark_df())
+
     def to_spark_df(self) -> pyspark.sql.DataFrame:
-        statements = self.query.split(
-            "---EOS---"
-        )  # TODO can do better than this dirty split
-        *_, last = map(self.spark_session.sql, statements)
-        return last
+        if self._final_df is None:
+            for statement in self._statements[:-1]:
+                self.spark_session.sql(statement)
+            self._final_df = self._final_statement_df()
+        return self._final_df
+
+    def _final_statement_df(self) -> pyspark.sql.DataFrame:
+        if self._query_args:
+            # parameters are only bound in the final statement
+            return self.spark_session.sql(self._statements[-1], args=self._query_args)
+        return self.spark_session.sql(self._statements[-1])
+
+    @contextmanager
+    def _collected_df(self) -> Iterator[pyspark.sql.DataFrame]:
+        """Yields the dataframe to collect, with the Arrow settings applied and the
+        intermediate views it reads cached until collected"""
+        with _session_conf(self.spark_session, self._arrow_conf):
+            with self._cached_views_df() as spark_df:
+                yield spark_df
+
+    @contextmanager
+    def _cached_views_df(self) -> Iterator[pyspark.sql.DataFrame]:
+        spark_df = self.to_spark_df()
+        cached_views = []
+        if self._cache_intermediate and len(self._statements) > 1:
+            # every feature view join reads from the entity dataframe
+            cached_views.append("entity_dataframe")
+        cached_views.extend(self._parallel_views or [])
+        if not cached_views:
+            yield spark_df
+            return
+
+        errors = []
+
+        def materialize(view_name: str):
+            try:
+                if self._scheduler_pool:
+                    # local properties are per thread with pinned thread mode
+                    self.spark_session.sparkContext.setLocalProperty(
+                        "spark.scheduler.pool", self._scheduler_pool
+                    )
+                self.spark_session.catalog.cacheTable(view_name)
+                self.spark_session.table(view_name).count()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            InheritableThread(target=materialize, args=(view_name,))
+            for view_name in self._parallel_views or []
+        ]
+        try:
+            if "entity_dataframe" in cached_views:
+                # lazy, filled by the first job reading it
+                self.spark_session.catalog.cacheTable("entity_dataframe")
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            # analyzed after caching to read from the cache entries, which are released
+            # below, so the memoized dataframe would not find them on a later collect
+            yield self._final_statement_df()
+        finally:
+            for view_name in cached_views:
+                self.spark_session.catalog.uncacheTable(view_name)
 
     def to_df(self) -> pandas.DataFrame:
-        return self.to_spark_df().toPandas()  # noqa, DataFrameLike instead of DataFrame
+        with self._collected_df() as spark_df:
+            # collects Arrow batches when enabled, localizing timestamps like without Arrow
+            return spark_df.toPandas()  # noqa, DataFrameLike instead of DataFrame
 
     def _to_df_internal(self) -> pd.DataFrame:
         """Return dataset as Pandas DataFrame synchronously"""
@@ -190,31 +370,168 @@ class SparkRetrievalJob(RetrievalJob):
         pass
 
     def to_arrow(self) -> pyarrow.Table:
-        df = self.to_df()
-        return pyarrow.Table.from_pandas(df)  # noqa
+        try:
+            arrow_schema = self.schema
+        except TypeError:
+            # schema contains types unsupported by Arrow, left to pandas
+            with self._collected_df() as spark_df:
+                return pyarrow.Table.from_pandas(spark_df.toPandas())  # noqa
+        return pyarrow.Table.from_batches(
+            list(self.to_arrow_batches()), schema=arrow_schema
+        )
+
+    def to_arrow_batches(self) -> Iterator[pyarrow.RecordBatch]:
+        """Return dataset as an iterator of pyarrow RecordBatches
+
+        Batches are fetched from the executors one partition at a time, so the
+        driver only holds the partition being read. Raises TypeError for Spark
+        types Arrow does not support.
+        """
+        arrow_schema = self.schema
+        with self._collected_df() as spark_df:
+            if not _is_arrow_enabled(self.spark_session):
+                table = _collect_as_arrow_without_arrow(spark_df, arrow_schema)
+                yield from table.to_batches()
+                return
+            yield from _stream_arrow_batches(self.spark_session, spark_df, arrow_schema)
+
+
+def _get_arrow_schema(
+    spark_session: SparkSession, spark_df: pyspark.sql.DataFrame
+) -> pyarrow.Schema:
+    """Returns the Arrow schema the JVM sends the dataframe with, raises TypeError
+    for types unsupported by Arrow"""
+    arrow_schema = to_arrow_schema(spark_df.schema)
+    # to_arrow_schema assumes UTC, while the JVM uses the session timezone
+    session_timezone = spark_session.conf.get("spark.sql.session.timeZone")
+    for i, field in enumerate(arrow_schema):
+        if pyarrow.types.is_timestamp(field.type) and field.type.tz is not None:
+            arrow_schema = arrow_schema.set(
+                i, field.with_type(pyarrow.timestamp("us", tz=session_timezone))
+            )
+    return arrow_schema
+
+
+def _stream_arrow_batches(
+    spark_session: SparkSession,
+    spark_df: pyspark.sql.DataFrame,
+    arrow_schema: pyarrow.Schema,
+) -> Iterator[pyarrow.RecordBatch]:
+    # each element of the RDD is a record batch serialized without its schema
+    jrdd = spark_df._jdf.toArrowBatchRdd()
+    sock_info = spark_session.sparkContext._jvm.PythonRDD.toLocalIteratorAndServe(
+        jrdd, False
+    )
+    for serialized_batch in _local_iterator_from_socket(sock_info, NoOpSerializer()):
+        yield pyarrow.ipc.read_record_batch(
+            pyarrow.py_buffer(serialized_batch), arrow_schema
+        )
+
+
+def _collect_as_arrow_without_arrow(
+    spark_df: pyspark.sql.DataFrame, arrow_schema: pyarrow.Schema
+) -> pyarrow.Table:
+    """Collects through pandas and casts to the schema Arrow would have collected"""
+    timestamp_columns = {
+        field.name
+        for field in spark_df.schema.fields
+        if isinstance(field.dataType, TimestampType)
+    }
+    # collected rows hold naive local datetimes, epoch microseconds are exact
+    pdf = spark_df.select(
+        *[
+            (
+                expr(f"unix_micros(`{name}`)").alias(name)
+                if name in timestamp_columns
+                else spark_df[name]
+            )
+            for name in spark_df.columns
+        ]
+    ).toPandas()
+    for name in timestamp_columns:
+        pdf[name] = pd.to_datetime(pdf[name], unit="us", utc=True)
+    return pyarrow.Table.from_pandas(pdf, preserve_index=False).cast(arrow_schema)
 
 
 def _upload_entity_df_and_get_entity_schema(
     spark_session, table_name, entity_df
 ) -> Dict[str, np.dtype]:
     if isinstance(entity_df, pd.DataFrame):
+        # converted through Arrow when enabled, falling back for unsupported types
         spark_session.createDataFrame(entity_df).createOrReplaceTempView(table_name)
-        return dict(zip(entity_df.columns, entity_df.dtypes))
+        return entity_df.dtypes.to_dict()
     elif isinstance(entity_df, str):
         spark_session.sql(entity_df).createOrReplaceTempView(table_name)
         limited_entity_df = spark_session.table(table_name)
         # limited_entity_df = spark_session.table(table_name).limit(1).toPandas()
 
+        # a single call, as .columns would fetch the schema from the JVM again
+        dtypes = limited_entity_df.dtypes
         return dict(
-            zip(
-                limited_entity_df.columns,
-                spark_schema_to_np_dtypes(limited_entity_df.dtypes),
-            )
+            zip((name for name, _ in dtypes), spark_schema_to_np_dtypes(dtypes))
         )
     else:
         raise InvalidEntityType(type(entity_df))
 
 
+def _get_entity_df_timestamp_bounds(
+    spark_session: SparkSession, table_name: str, entity_df_event_timestamp_col: str
+) -> Tuple[Optional[int], Optional[int]]:
+    # epoch microseconds are exact, local time strings are ambiguous at DST changes
+    row = spark_session.sql(f"""
+        SELECT unix_micros(MIN({entity_df_event_timestamp_col})),
+               unix_micros(MAX({entity_df_event_timestamp_col}))
+        FROM {table_name}
+        """).collect()[0]
+    # both are None for an empty entity dataframe
+    return row[0], row[1]
+
+
+def _entity_df_fits_broadcast_threshold(
+    spark_session: SparkSession, entity_df: Union[pandas.DataFrame, str]
+) -> bool:
+    if not isinstance(entity_df, pd.DataFrame):
+        # size of a SQL entity dataframe is unknown before execution, leave it to AQE
+        return False
+    threshold = _parse_byte_size(
+        spark_session.conf.get("spark.sql.autoBroadcastJoinThreshold", "10m")
+    )
+    return 0 <= entity_df.memory_usage(deep=True).sum() <= threshold
+
+
+def _parse_byte_size(size: str) -> int:
+    # follows Spark's byte string format, e.g. "10485760", "10m" or "10MB"
+    match = re.fullmatch(r"\s*(-?\d+)\s*([kmgtp]?)b?\s*", size.lower())
+    if not match:
+        return -1
+    value, unit = match.groups()
+    return int(value) * 1024 ** "bkmgtp".index(unit or "b")
+
+
+def _build_point_in_time_query(
+    feature_view_query_contexts: List[offline_utils.FeatureViewQueryContext],
+    left_table_query_string: str,
+    entity_df_event_timestamp_col: str,
+    min_entity_timestamp: Optional[int],
+    max_entity_timestamp: Optional[int],
+    broadcast_entity_df: bool = False,
+    full_feature_names: bool = False,
+) -> str:
+    """Build point-in-time query between each feature view table and the entity dataframe"""
+    # offline_utils.build_point_in_time_query does not accept extra template
+    # context, which we need to inline the entity timestamp bounds as literals
+    template_context = {
+        "left_table_query_string": left_table_query_string,
+        "entity_df_event_timestamp_col": entity_df_event_timestamp_col,
+        "min_entity_timestamp": min_entity_timestamp,
+        "max_entity_timestamp": max_entity_timestamp,
+        "broadcast_entity_df": broadcast_entity_df,
+        "featureviews": [asdict(context) for context in feature_view_query_contexts],
+        "full_feature_names": full_feature_names,
+    }
+    return _POINT_IN_TIME_JOIN_TEMPLATE.render(template_context)
+
+
 def get_spark_session_or_start_new_with_repoconfig(
     store_config: SparkOfflineStoreConfig,
 ) -> SparkSession:
@@ -222,28 +539,85 @@ def get_spark_session_or_start_new_with_repoconfig(
 
     if not spark_session:
         spark_builder = SparkSession.builder
-        spark_conf = store_config.spark_conf
+        # user configuration takes precedence over our defaults
+        spark_conf = {**_DEFAULT_SPARK_CONF, **(store_config.spark_conf or {})}
 
-        if spark_conf:
-            spark_builder = spark_builder.config(
-                conf=SparkConf().setAll(spark_conf.items())
-            )  # noqa
+        spark_builder = spark_builder.config(
+            conf=SparkConf().setAll(spark_conf.items())
+        )  # noqa
 
         spark_session = spark_builder.getOrCreate()
 
+    if getattr(spark_session, "_feast_store_config", None) == store_config:
+        # already configured, skip the py4j round-trips of conf.set
+        return spark_session
+
     spark_session.conf.set(
         "spark.sql.parser.quotedRegexColumnNames", "true"
     )  # important!
+    spark_session._feast_store_config = store_config
 
     return spark_session
 
 
-def _format_datetime(t: datetime):
+def _get_arrow_conf(store_config: SparkOfflineStoreConfig) -> Dict[str, str]:
+    """Arrow settings for converting between Spark and pandas, spark_conf takes precedence"""
+    arrow_conf = {
+        "spark.sql.execution.arrow.pyspark.enabled": str(
+            store_config.arrow_enabled
+        ).lower(),
+        "spark.sql.execution.arrow.pyspark.fallback.enabled": "true",
+        # lets toPandas free each Arrow column once converted (Spark >= 3.2)
+        "spark.sql.execution.arrow.pyspark.selfDestruct.enabled": "true",
+    }
+    if store_config.batch_size:
+        arrow_conf["spark.sql.execution.arrow.maxRecordsPerBatch"] = str(
+            store_config.batch_size
+        )
+    spark_conf = store_config.spark_conf or {}
+    return {key: spark_conf.get(key, value) for key, value in arrow_conf.items()}
+
+
+@contextmanager
+def _session_conf(spark_session: SparkSession, conf: Dict[str, str]):
+    """Sets the runtime configuration for the duration of a call, restoring the previous values"""
+    previous = {key: spark_session.conf.get(key, None) for key in conf}
+    for key, value in conf.items():
+        spark_session.conf.set(key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                spark_session.conf.unset(key)
+            else:
+                spark_session.conf.set(key, value)
+
+
+def _is_arrow_enabled(spark_session: SparkSession) -> bool:
+    return (
+        spark_session.conf.get("spark.sql.execution.arrow.pyspark.enabled", "false")
+        == "true"
+    )
+
+
+def _sort_by_cardinality(
+    columns: List[str], cardinalities: Optional[Dict[str, int]]
+) -> List[str]:
+    # high-cardinality columns first let the window sort comparator short-circuit early
+    if not cardinalities:
+        return columns
+    return sorted(columns, key=lambda c: cardinalities.get(c, 0), reverse=True)
+
+
+def _format_datetime(t: datetime) -> str:
     # Since Hive does not support timezone, need to transform to utc.
-    if t.tzinfo:
-        t = t.astimezone(tz=utc)
-    t = t.strftime("%Y-%m-%d %H:%M:%S.%f")
-    return t
+    if t.tzinfo is not None:
+        t = t.astimezone(_UTC)
+    return (
+        f"{t.year:04d}-{t.month:02d}-{t.day:02d} "
+        f"{t.hour:02d}:{t.minute:02d}:{t.second:02d}.{t.microsecond:06d}"
+    )
 
 
 MULTIPLE_FEATURE_VIEW_POINT_IN_TIME_JOIN = """/*
@@ -254,11 +628,11 @@ CREATE OR REPLACE TEMPORARY VIEW entity_dataframe AS (
     SELECT *,
         {{entity_df_event_timestamp_col}} AS entity_timestamp
         {% for featureview in featureviews %}
-            ,CONCAT(
+            ,xxhash64(
                 {% for entity in featureview.entities %}
-                    CAST({{entity}} AS STRING),
+                    {{entity}},
                 {% endfor %}
-                CAST({{entity_df_event_timestamp_col}} AS STRING)
+                {{entity_df_event_timestamp_col}}
             ) AS {{featureview.name}}__entity_row_unique_id
         {% endfor %}
     FROM {{ left_table_query_string }}
@@ -268,7 +642,7 @@ CREATE OR REPLACE TEMPORARY VIEW entity_dataframe AS (
 ---EOS---
 
 
--- Start create temporary table *__base
+-- Start create temporary tables *__base and *__cleaned, one statement each
 {% for featureview in featureviews %}
 
 CREATE OR REPLACE TEMPORARY VIEW {{ featureview.name }}__base AS
@@ -307,21 +681,16 @@ WITH {{ featureview.name }}__entity_dataframe AS (
             {{ feature }} as {% if full_feature_names %}{{ featureview.name }}__{{feature}}{% else %}{{ feature }}{% endif %}{% if loop.last %}{% else %}, {% endif %}
         {% endfor %}
     FROM {{ featureview.table_subquery }} AS subquery
-    INNER JOIN (
-        SELECT MAX(entity_timestamp) as max_entity_timestamp_
-               {% if featureview.ttl == 0 %}{% else %}
-               ,(MIN(entity_timestamp) - interval '{{ featureview.ttl }}' second) as min_entity_timestamp_
-               {% endif %}
-        FROM entity_dataframe
-    ) AS temp
-    ON (
-        {{ featureview.event_timestamp_column }} <= max_entity_timestamp_
-        {% if featureview.ttl == 0 %}{% else %}
-        AND {{ featureview.event_timestamp_column }} >=  min_entity_timestamp_
-        {% endif %}
-    )
+    {% if max_entity_timestamp is none %}
+    WHERE FALSE
+    {% else %}
+    WHERE {{ featureview.event_timestamp_column }} <= timestamp_micros({{ max_entity_timestamp }})
+    {% if featureview.ttl == 0 %}{% else %}
+    AND {{ featureview.event_timestamp_column }} >= timestamp_micros({{ min_entity_timestamp }}) - interval '{{ featureview.ttl }}' second
+    {% endif %}
+    {% endif %}
 )
-SELECT
+SELECT {% if broadcast_entity_df %}/*+ BROADCAST(entity_dataframe) */{% endif %}
     subquery.*,
     entity_dataframe.entity_timestamp,
     entity_dataframe.{{featureview.name}}__entity_row_unique_id
@@ -345,88 +714,50 @@ ON (
     {% endfor %}
 );
 
-{% endfor %}
--- End create temporary table *__base
-
 ---EOS---
 
-{% for featureview in featureviews %}
-
-{% if loop.first %}WITH{% endif %}
-
-/*
- 2. If the `created_timestamp_column` has been set, we need to
- deduplicate the data first. This is done by calculating the
- `MAX(created_at_timestamp)` for each event_timestamp.
- We then join the data on the next CTE
-*/
-{% if featureview.created_timestamp_column %}
-{{ featureview.name }}__dedup AS (
-    SELECT
-        {{featureview.name}}__entity_row_unique_id,
-        event_timestamp,
-        MAX(created_timestamp) as created_timestamp
-    FROM {{ featureview.name }}__base
-    GROUP BY {{featureview.name}}__entity_row_unique_id, event_timestamp
-),
-{% endif %}
-
 /*
- 3. The data has been filtered during the first CTE "*__base"
- Thus we only need to compute the latest timestamp of each feature.
+ 2. The data has been filtered during the first view "*__base"
+ Thus we only need to keep the latest row of each feature. If the
+ `created_timestamp_column` has been set, it breaks ties between rows
+ sharing the same event_timestamp.
 */
-{{ featureview.name }}__latest AS (
-    SELECT
-        base.{{featureview.name}}__entity_row_unique_id,
-        MAX(base.event_timestamp) AS event_timestamp
-        {% if featureview.created_timestamp_column %}
-            ,MAX(base.created_timestamp) AS created_timestamp
-        {% endif %}
-
+CREATE OR REPLACE TEMPORARY VIEW {{ featureview.name }}__cleaned AS
+SELECT *
+FROM (
+    SELECT base.*,
+        ROW_NUMBER() OVER(
+            PARTITION BY base.{{featureview.name}}__entity_row_unique_id,
+            {% for entity in featureview.entities %}
+                base.{{ entity }},
+            {% endfor %}
+                base.entity_timestamp
+            ORDER BY base.event_timestamp DESC{% if featureview.created_timestamp_column %}, base.created_timestamp DESC{% endif %}
+        ) AS feast_row_
     FROM {{ featureview.name }}__base AS base
-    {% if featureview.created_timestamp_column %}
-        INNER JOIN {{ featureview.name }}__dedup AS dedup
-        ON (
-            dedup.{{featureview.name}}__entity_row_unique_id=base.{{featureview.name}}__entity_row_unique_id
-            AND dedup.event_timestamp=base.event_timestamp
-            AND dedup.created_timestamp=base.created_timestamp
-        )
-    {% endif %}
-
-    GROUP BY base.{{featureview.name}}__entity_row_unique_id
-),
-
-/*
- 4. Once we know the latest value of each feature for a given timestamp,
- we can join again the data back to the original "base" dataset
-*/
-{{ featureview.name }}__cleaned AS (
-    SELECT base.*
-    FROM {{ featureview.name }}__base AS base
-    INNER JOIN {{ featureview.name }}__latest AS latest
-    ON (
-        base.{{featureview.name}}__entity_row_unique_id=latest.{{featureview.name}}__entity_row_unique_id
-        AND base.event_timestamp=latest.event_timestamp
-        {% if featureview.created_timestamp_column %}
-            AND base.created_timestamp=latest.created_timestamp
-        {% endif %}
-    )
-){% if loop.last %}{% else %}, {% endif %}
+) AS ranked
+WHERE feast_row_ = 1;
 
+---EOS---
 
 {% endfor %}
+-- End create temporary table *__cleaned
 
 /*
  Joins the outputs of multiple time travel joins to a single table.
  The entity_dataframe dataset being our source of truth here.
  */
 
-SELECT `(entity_timestamp|{% for featureview in featureviews %}{{featureview.name}}__entity_row_unique_id{% if loop.last %}{% else %}|{% endif %}{% endfor %})?+.+`
+SELECT `(entity_timestamp|{% for featureview in featureviews %}{{featureview.name}}__entity_row_unique_id|{{featureview.name}}__entity_timestamp{% for entity in featureview.entities %}|{{featureview.name}}__{{entity}}__join_key{% endfor %}{% if loop.last %}{% else %}|{% endif %}{% endfor %})?+.+`
 FROM entity_dataframe
 {% for featureview in featureviews %}
 LEFT JOIN (
     SELECT
-        {{featureview.name}}__entity_row_unique_id
+        {{featureview.name}}__entity_row_unique_id,
+        entity_timestamp AS {{featureview.name}}__entity_timestamp
+        {% for entity in featureview.entities %}
+            ,{{ entity }} AS {{featureview.name}}__{{entity}}__join_key
+        {% endfor %}
         {% for feature in featureview.features %}
             ,{% if full_feature_names %}{{ featureview.name }}__{{feature}}{% else %}{{ feature }}{% endif %}
         {% endfor %}
@@ -434,5 +765,15 @@ LEFT JOIN (
 ) AS {{ featureview.name }}__joined
 ON (
     {{ featureview.name }}__joined.{{featureview.name}}__entity_row_unique_id=entity_dataframe.{{featureview.name}}__entity_row_unique_id
+    /* the row id is a hash, compare the actual keys as well to rule out collisions */
+    AND {{ featureview.name }}__joined.{{featureview.name}}__entity_timestamp=entity_dataframe.entity_timestamp
+    {% for entity in featureview.entities %}
+    AND {{ featureview.name }}__joined.{{featureview.name}}__{{entity}}__join_key=entity_dataframe.{{ entity }}
+    {% endfor %}
 )
 {% endfor %}"""
+
+# compiled once at import instead of on every get_historical_features call
+_POINT_IN_TIME_JOIN_TEMPLATE = Environment(loader=BaseLoader()).from_string(
+    source=MULTIPLE_FEATURE_VIEW_POINT_IN_TIME_JOIN
+)
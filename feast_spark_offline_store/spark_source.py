@@ -1,10 +1,11 @@
-from typing import Optional, Dict, Callable, Any, Tuple, Iterable
+from typing import Optional, Dict, Callable, Any, Tuple, Iterable, List
 from feast.data_source import DataSource
 from feast.repo_config import RepoConfig
 from pyspark.sql.utils import AnalysisException
 from feast.value_type import ValueType
 from feast.protos.feast.core.DataSource_pb2 import DataSource as DataSourceProto
 from feast_spark_offline_store.spark_type_map import spark_to_feast_value_type
+import json
 import pickle
 from feast.errors import DataSourceNotFoundException
 
@@ -39,6 +40,7 @@ class SparkSource(DataSource):
             # format=format,
             # options=options,
         )
+        self._table_column_names_and_types: Dict[str, List[Tuple[str, str]]] = {}
 
     @property
     def spark_options(self):
@@ -112,6 +114,10 @@ class SparkSource(DataSource):
     def get_table_column_names_and_types(
         self, config: RepoConfig
     ) -> Iterable[Tuple[str, str]]:
+        cache_key = self.table or self.query
+        if cache_key in self._table_column_names_and_types:
+            return self._table_column_names_and_types[cache_key]
+
         from feast_spark_offline_store.spark import (
             get_spark_session_or_start_new_with_repoconfig,
         )
@@ -120,14 +126,19 @@ class SparkSource(DataSource):
             config.offline_store
         )
         try:
-            return (
-                (fields["name"], fields["type"])
-                for fields in spark_session.table(self.table).schema.jsonValue()[
-                    "fields"
-                ]
-            )
+            # only analyzes the plan, nothing is executed to get the schema
+            if self.table:
+                fields = spark_session.table(self.table).schema.fields
+            else:
+                fields = spark_session.sql(self.query).schema.fields
         except AnalysisException:
-            raise DataSourceNotFoundException(self.table)
+            raise DataSourceNotFoundException(cache_key)
+
+        column_names_and_types = [
+            (field.name, field.dataType.simpleString()) for field in fields
+        ]
+        self._table_column_names_and_types[cache_key] = column_names_and_types
+        return column_names_and_types
 
     def get_table_query_string(self) -> str:
         """Returns a string that can directly be used to reference this table in SQL"""
@@ -185,11 +196,19 @@ class SparkOptions:
         Returns:
             Returns a SparkOptions object based on the spark_options protobuf
         """
-        spark_configuration = pickle.loads(spark_options_proto.configuration)
+        try:
+            spark_configuration = json.loads(spark_options_proto.configuration)
+        except ValueError:
+            # TODO remove once registries serialized with pickle have been migrated
+            legacy_spark_options = pickle.loads(spark_options_proto.configuration)
+            spark_configuration = {
+                "table": legacy_spark_options.table,
+                "query": legacy_spark_options.query,
+            }
 
         spark_options = cls(
-            table=spark_configuration.table,
-            query=spark_configuration.query,
+            table=spark_configuration["table"],
+            query=spark_configuration["query"],
         )
         return spark_options
 
@@ -202,7 +221,9 @@ class SparkOptions:
         """
 
         spark_options_proto = DataSourceProto.CustomSourceOptions(
-            configuration=pickle.dumps(self),
+            configuration=json.dumps(
+                {"table": self._table, "query": self._query}
+            ).encode(),
         )
 
         return spark_options_proto
@@ -4,11 +4,10 @@ from setuptools import find_packages
 
 INSTALL_REQUIRES = [
     "feast>=0.15.0",
-    "pyspark>=3.0",
-    "pyarrow>=1.0.0",
+    "pyspark>=3.1",
+    "pyarrow>=2.0.0",
     "numpy",
     "pandas",
-    "pytz>=2021.3",
     "pydantic>=1.6",
 ]
 
@@ -1,10 +1,33 @@
 import os
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
-from feast import FeatureStore
+from google.protobuf.duration_pb2 import Duration
 
-from example_feature_repo.example import driver, driver_hourly_stats_view
+from feast import Feature, FeatureStore, FeatureView, ValueType
+
+from feast_spark_offline_store import SparkSource
+from feast_spark_offline_store.spark import (
+    _format_datetime,
+    _parse_byte_size,
+    _sort_by_cardinality,
+)
+
+from example_feature_repo.example import (
+    driver,
+    driver_hourly_stats,
+    driver_hourly_stats_view,
+)
+
+driver_daily_trips_view = FeatureView(
+    name="driver_daily_trips",
+    entities=["driver_id"],
+    ttl=Duration(seconds=86400 * 1),
+    features=[Feature(name="avg_daily_trips", dtype=ValueType.INT64)],
+    online=True,
+    batch_source=driver_hourly_stats,
+    tags={},
+)
 
 
 def test_end_to_end():
@@ -36,6 +59,108 @@ def test_end_to_end():
         fs.teardown()
 
 
+def test_end_to_end_multiple_feature_views():
+    fs = FeatureStore("example_feature_repo/")
+
+    try:
+        fs.apply([driver, driver_hourly_stats_view, driver_daily_trips_view])
+
+        entity_df = pd.DataFrame(
+            {
+                "driver_id": [1001, 1002],
+                "event_timestamp": [datetime.now(), datetime.now()],
+            }
+        )
+
+        # each feature view is created by its own statement
+        feature_vector = (
+            fs.get_historical_features(
+                features=[
+                    "driver_hourly_stats:conv_rate",
+                    "driver_daily_trips:avg_daily_trips",
+                ],
+                entity_df=entity_df,
+            )
+            .to_df()
+            .to_dict()
+        )
+        assert len(feature_vector["driver_id"]) == 2
+        assert feature_vector["conv_rate"][0] > 0
+        assert feature_vector["avg_daily_trips"][0] >= 0
+    finally:
+        fs.teardown()
+
+
+def test_end_to_end_retrieval_options():
+    fs = FeatureStore("example_feature_repo/")
+
+    entity_df = pd.DataFrame(
+        {"driver_id": [1001, 1002], "event_timestamp": [datetime.now()] * 2}
+    )
+
+    def get_historical_features():
+        return fs.get_historical_features(
+            features=[
+                "driver_hourly_stats:conv_rate",
+                "driver_daily_trips:avg_daily_trips",
+            ],
+            entity_df=entity_df,
+        )
+
+    def sorted_df(df):
+        return df.sort_values("driver_id").reset_index(drop=True)
+
+    try:
+        fs.apply([driver, driver_hourly_stats_view, driver_daily_trips_view])
+
+        job = get_historical_features()
+        expected_df = sorted_df(job.to_df())
+        expected_table = job.to_arrow()
+        assert job.schema == expected_table.schema
+        # a second collect on the same job
+        pd.testing.assert_frame_equal(sorted_df(job.to_df()), expected_df)
+
+        default_offline_store = fs.config.offline_store
+        for options in (
+            {"parallel_feature_views": True},
+            {"cache_intermediate": True},
+            {"parallel_feature_views": True, "cache_intermediate": True},
+        ):
+            fs.config.offline_store = default_offline_store.copy(update=options)
+            job = get_historical_features()
+            pd.testing.assert_frame_equal(sorted_df(job.to_df()), expected_df)
+            pd.testing.assert_frame_equal(sorted_df(job.to_df()), expected_df)
+            assert job.schema == job.to_arrow().schema
+
+        # without Arrow, to_arrow is cast to the same schema
+        fs.config.offline_store = default_offline_store.copy(
+            update={"arrow_enabled": False}
+        )
+        job = get_historical_features()
+        table = job.to_arrow()
+        assert job.schema == table.schema == expected_table.schema
+        pd.testing.assert_frame_equal(
+            sorted_df(table.to_pandas()), sorted_df(expected_table.to_pandas())
+        )
+    finally:
+        fs.teardown()
+
+
+def test_spark_source_query_validates():
+    fs = FeatureStore("example_feature_repo/")
+
+    spark_source = SparkSource(
+        query="SELECT * FROM driver_stats WHERE driver_id > 1000",
+        event_timestamp_column="event_timestamp",
+        created_timestamp_column="created",
+    )
+
+    spark_source.validate(fs.config)
+    assert ("driver_id", "bigint") in spark_source.get_table_column_names_and_types(
+        fs.config
+    )
+
+
 def test_cli():
     repo_name = "example_feature_repo"
     os.system(f"PYTHONPATH=$PYTHONPATH:/$(pwd) feast -c {repo_name} apply")
@@ -53,3 +178,38 @@ def test_cli():
             )
     finally:
         os.system(f"PYTHONPATH=$PYTHONPATH:/$(pwd) feast -c {repo_name} teardown")
+
+
+def test_format_datetime():
+    assert (
+        _format_datetime(datetime(2021, 8, 19, 22, 29, 28, 1))
+        == "2021-08-19 22:29:28.000001"
+    )
+    # timezone aware datetimes are converted to utc
+    assert (
+        _format_datetime(
+            datetime(2021, 8, 19, 22, 29, 28, tzinfo=timezone(timedelta(hours=2)))
+        )
+        == "2021-08-19 20:29:28.000000"
+    )
+
+
+def test_parse_byte_size():
+    assert _parse_byte_size("10485760") == 10485760
+    assert _parse_byte_size("10485760b") == 10485760
+    assert _parse_byte_size("10m") == 10 * 1024 * 1024
+    assert _parse_byte_size("10MB") == 10 * 1024 * 1024
+    assert _parse_byte_size("1g") == 1024 * 1024 * 1024
+    # disabled or unparsable thresholds never allow a broadcast
+    assert _parse_byte_size("-1") == -1
+    assert _parse_byte_size("abc") == -1
+
+
+def test_sort_by_cardinality():
+    assert _sort_by_cardinality(["a", "b"], None) == ["a", "b"]
+    # columns without a known cardinality keep their order at the end
+    assert _sort_by_cardinality(["a", "b", "c"], {"b": 100, "a": 10}) == [
+        "b",
+        "a",
+        "c",
+    ]
@@ -0,0 +1,33 @@
+import json
+import pickle
+
+from feast.protos.feast.core.DataSource_pb2 import DataSource as DataSourceProto
+
+from feast_spark_offline_store.spark_source import SparkOptions
+
+
+def test_spark_options_proto_round_trip():
+    spark_options = SparkOptions(table="driver_stats", query=None)
+
+    spark_options_proto = spark_options.to_proto()
+    assert json.loads(spark_options_proto.configuration) == {
+        "table": "driver_stats",
+        "query": None,
+    }
+
+    loaded_spark_options = SparkOptions.from_proto(spark_options_proto)
+    assert loaded_spark_options.table == "driver_stats"
+    assert loaded_spark_options.query is None
+
+
+def test_spark_options_from_legacy_pickled_proto():
+    # registries written before the switch to JSON hold a pickled SparkOptions
+    spark_options_proto = DataSourceProto.CustomSourceOptions(
+        configuration=pickle.dumps(
+            SparkOptions(table=None, query="SELECT * FROM driver_stats")
+        ),
+    )
+
+    spark_options = SparkOptions.from_proto(spark_options_proto)
+    assert spark_options.table is None
+    assert spark_options.query == "SELECT * FROM driver_stats"